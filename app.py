@@ -1,14 +1,19 @@
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse, PlainTextResponse
-from groq import Groq
+from fastapi.responses import PlainTextResponse, Response
+from groq import AsyncGroq
 import os
 import hmac
 import hashlib
 import time
-import json
+import orjson
 import httpx
 import asyncio
+import logging
+import ssl
+import platform
+from urllib.parse import parse_qs
 from dotenv import load_dotenv
+from cachetools import TTLCache
 
 load_dotenv()
 
@@ -19,130 +24,335 @@ SLACK_BOT_TOKEN = os.getenv("SLACK_BOT_TOKEN")
 if not GROQ_API_KEY or not SLACK_SIGNING_SECRET or not SLACK_BOT_TOKEN:
     raise RuntimeError("Missing one or more environment variables.")
 
-client = Groq(api_key=GROQ_API_KEY)
+_SIGNING_SECRET_BYTES = SLACK_SIGNING_SECRET.encode("ascii")
+
+# Keyed HMAC state, copied per request so the key schedule is only computed once
+_HMAC_TEMPLATE = hmac.new(_SIGNING_SECRET_BYTES, b"", hashlib.sha256)
+
+# Every Slack Web API call is a JSON POST with the bot token, so the base URL
+# and headers live on the shared client and call sites pass only a path.
+SLACK_API_BASE_URL = "https://slack.com/api/"
+VIEWS_OPEN_PATH = "views.open"
+POST_MESSAGE_PATH = "chat.postMessage"
+SLACK_HEADERS = {
+    "Content-Type": "application/json; charset=utf-8",
+    "Authorization": f"Bearer {SLACK_BOT_TOKEN}",
+}
+
+client = AsyncGroq(api_key=GROQ_API_KEY)
 app = FastAPI()
+logger = logging.getLogger("uvicorn.error")
+
+# --- Crypto backend check (HMAC-SHA256 is the per-request CPU cost) ---
+# /proc/cpuinfo line prefix and flag naming SHA-256 instructions, per architecture
+_SHA256_CPU_FLAGS = {
+    "x86_64": ("flags", "sha_ni"),
+    "AMD64": ("flags", "sha_ni"),
+    "aarch64": ("Features", "sha2"),
+    "arm64": ("Features", "sha2"),
+}
+
+# None means unknown (other architectures, or no /proc/cpuinfo)
+def cpu_has_sha256_instructions():
+    probe = _SHA256_CPU_FLAGS.get(platform.machine())
+    if probe is None:
+        return None
+    field, flag = probe
+    try:
+        with open("/proc/cpuinfo") as f:
+            return any(line.startswith(field) and flag in line.split() for line in f)
+    except OSError:
+        return None
+
+@app.on_event("startup")
+async def check_crypto_backend():
+    logger.info("hashlib backend: %s", ssl.OPENSSL_VERSION)
+    if ssl.OPENSSL_VERSION_INFO < (1, 1, 1):
+        logger.warning("OpenSSL older than 1.1.1; SHA-256 may not use hardware acceleration.")
+    if cpu_has_sha256_instructions() is False:
+        logger.warning("CPU does not report SHA-256 instructions; Slack signature checks will use scalar SHA-256.")
+
+@app.on_event("startup")
+async def check_event_loop():
+    loop_class = type(asyncio.get_running_loop())
+    logger.info("event loop: %s.%s", loop_class.__module__, loop_class.__qualname__)
+    if not loop_class.__module__.startswith("uvloop"):
+        logger.warning("Not running on uvloop; start with `python app.py` or `uvicorn --loop uvloop --http httptools`.")
+
+# --- Shared Slack HTTP client (pooled keep-alive connections) ---
+@app.on_event("startup")
+async def open_http_client():
+    app.state.http = httpx.AsyncClient(
+        timeout=10,
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=32),
+        base_url=SLACK_API_BASE_URL,
+        headers=SLACK_HEADERS,
+    )
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await app.state.http.aclose()
+
+# --- Request size limit (Slack payloads stay well under 64 KB) ---
+# Plain ASGI middleware: oversized Content-Length is rejected up front, and
+# bodies without one (chunked) are counted as they stream in, so no request
+# can make the handlers buffer or hash more than MAX_BODY_BYTES.
+MAX_BODY_BYTES = 128 * 1024
+
+class BodySizeLimitMiddleware:
+    def __init__(self, app, max_body_bytes: int):
+        self.app = app
+        self.max_body_bytes = max_body_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        for name, value in scope["headers"]:
+            if name == b"content-length":
+                # Same {"detail": ...} JSON shape FastAPI uses for HTTPException
+                if not value.isdigit():
+                    status_code, detail = 400, "Invalid Content-Length."
+                elif int(value) > self.max_body_bytes:
+                    status_code, detail = 413, "Request body too large."
+                else:
+                    break
+                response = Response(
+                    content=orjson.dumps({"detail": detail}),
+                    status_code=status_code,
+                    media_type="application/json",
+                )
+                await response(scope, receive, send)
+                return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_body_bytes:
+                    # Raised inside request.body(), so the endpoint's exception
+                    # handling turns it into a 413 before any response is sent.
+                    raise HTTPException(status_code=413, detail="Request body too large.")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+app.add_middleware(BodySizeLimitMiddleware, max_body_bytes=MAX_BODY_BYTES)
 
 # --- Slack Signature Verification ---
-def verify_slack_signature(request: Request, body: bytes):
+# Max allowed clock skew either side of now for X-Slack-Request-Timestamp
+MAX_TIMESTAMP_SKEW = 60 * 5
+
+# Header checks run before the body is read so stale or malformed requests
+# are rejected without buffering the body or doing any HMAC work.
+def precheck_timestamp(request: Request):
     timestamp = request.headers.get("X-Slack-Request-Timestamp")
     slack_signature = request.headers.get("X-Slack-Signature")
     if not timestamp or not slack_signature:
         raise HTTPException(status_code=400, detail="Missing Slack headers.")
-    if abs(time.time() - int(timestamp)) > 60 * 5:
+    try:
+        ts_int = int(timestamp)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid Slack timestamp.")
+    if abs(time.time() - ts_int) > MAX_TIMESTAMP_SKEW:
         raise HTTPException(status_code=400, detail="Request too old.")
-    sig_basestring = f"v0:{timestamp}:{body.decode()}"
-    computed_signature = "v0=" + hmac.new(
-        SLACK_SIGNING_SECRET.encode(), sig_basestring.encode(), hashlib.sha256
-    ).hexdigest()
-    if not hmac.compare_digest(computed_signature, slack_signature):
+    return timestamp, slack_signature
+
+def verify_body_signature(body: bytes, timestamp: str, slack_signature: str):
+    mac = _HMAC_TEMPLATE.copy()
+    mac.update(b"v0:" + timestamp.encode("latin-1") + b":" + body)
+    try:
+        expected = bytes.fromhex(slack_signature[3:]) if slack_signature.startswith("v0=") else b""
+    except ValueError:
+        expected = b""
+    if not hmac.compare_digest(mac.digest(), expected):
         raise HTTPException(status_code=403, detail="Invalid Slack signature.")
 
+# Signatures seen within the timestamp window. A timestamp is accepted for
+# MAX_TIMESTAMP_SKEW either side of now, i.e. for up to twice that long after
+# first receipt, so entries must live that long too. The cache is per
+# worker, so with WEB_CONCURRENCY > 1 a replay reaching another worker is not
+# caught. No lock is needed since the check-and-set below never awaits.
+_SEEN_SIGNATURES = TTLCache(maxsize=8192, ttl=2 * MAX_TIMESTAMP_SKEW)
+
+def is_replay(slack_signature: str) -> bool:
+    if slack_signature in _SEEN_SIGNATURES:
+        return True
+    _SEEN_SIGNATURES[slack_signature] = True
+    return False
+
+# --- Slack form bodies are always application/x-www-form-urlencoded ---
+def parse_slack_form(body: bytes, max_fields: int) -> dict:
+    try:
+        fields = parse_qs(body.decode("ascii", "replace"), max_num_fields=max_fields)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Malformed Slack form body.")
+    return {k: v[0] for k, v in fields.items()}
+
+# --- Background tasks ---
+# Strong references keep fire-and-forget tasks from being garbage collected
+# mid-flight; the semaphore caps concurrent Groq streams per worker, so the
+# overall limit is 8 * WEB_CONCURRENCY.
+_INFLIGHT: set[asyncio.Task] = set()
+_GROQ_SEM = asyncio.Semaphore(8)
+
+def spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _INFLIGHT.add(task)
+    task.add_done_callback(_INFLIGHT.discard)
+    return task
+
+async def run_bounded(coro):
+    async with _GROQ_SEM:
+        return await coro
+
+# --- Static Slack views, serialized once; only private_metadata varies ---
+# Each prefix is the view's JSON minus its closing brace, so per-request
+# fields can be appended with plain bytes concatenation.
+_MODEL_SELECT_VIEW_PREFIX = orjson.dumps({
+    "type": "modal",
+    "callback_id": "select_model",
+    "title": {"type": "plain_text", "text": "Select Model"},
+    "submit": {"type": "plain_text", "text": "Next"},
+    "blocks": [
+        {
+            "type": "input",
+            "block_id": "model_block",
+            "element": {
+                "type": "static_select",
+                "action_id": "model_action",
+                "placeholder": {"type": "plain_text", "text": "Choose a model"},
+                "options": [
+                    {
+                        "text": {"type": "plain_text", "text": "LLaMA 4 Scout"},
+                        "value": "meta-llama/llama-4-scout-17b-16e-instruct",
+                    },
+                    {
+                        "text": {"type": "plain_text", "text": "LLaMA 3 70B"},
+                        "value": "meta-llama/llama-3-70b-instruct",
+                    },
+                ],
+            },
+            "label": {"type": "plain_text", "text": "Model"},
+        }
+    ],
+})[:-1]
+
+_QUESTION_VIEW_PREFIX = orjson.dumps({
+    "type": "modal",
+    "callback_id": "submit_question",
+    "title": {"type": "plain_text", "text": "Ask a Question"},
+    "submit": {"type": "plain_text", "text": "Submit"},
+    "blocks": [
+        {
+            "type": "input",
+            "block_id": "question_block",
+            "element": {
+                "type": "plain_text_input",
+                "action_id": "question_action",
+                "multiline": True,
+            },
+            "label": {"type": "plain_text", "text": "Your question"},
+        }
+    ],
+})[:-1]
+
+def with_private_metadata(view_prefix: bytes, private_metadata) -> bytes:
+    return view_prefix + b',"private_metadata":' + orjson.dumps(private_metadata) + b"}"
+
 # --- Slack Command: /lama4 ---
 @app.post("/slack-llama")
 async def handle_command(request: Request):
+    timestamp, slack_signature = precheck_timestamp(request)
     body = await request.body()
-    verify_slack_signature(request, body)
-    form_data = dict((await request.form()).items())
+    verify_body_signature(body, timestamp, slack_signature)
+    if is_replay(slack_signature):
+        return PlainTextResponse("")
+    form_data = parse_slack_form(body, max_fields=32)
     trigger_id = form_data.get("trigger_id")
     channel_id = form_data.get("channel_id")  # ✅ Capture channel ID
 
-    modal_view = {
-        "type": "modal",
-        "callback_id": "select_model",
-        "private_metadata": channel_id,  # ✅ Pass channel ID in metadata
-        "title": {"type": "plain_text", "text": "Select Model"},
-        "submit": {"type": "plain_text", "text": "Next"},
-        "blocks": [
-            {
-                "type": "input",
-                "block_id": "model_block",
-                "element": {
-                    "type": "static_select",
-                    "action_id": "model_action",
-                    "placeholder": {"type": "plain_text", "text": "Choose a model"},
-                    "options": [
-                        {
-                            "text": {"type": "plain_text", "text": "LLaMA 4 Scout"},
-                            "value": "meta-llama/llama-4-scout-17b-16e-instruct",
-                        },
-                        {
-                            "text": {"type": "plain_text", "text": "LLaMA 3 70B"},
-                            "value": "meta-llama/llama-3-70b-instruct",
-                        },
-                    ],
-                },
-                "label": {"type": "plain_text", "text": "Model"},
-            }
-        ],
-    }
-
-    async with httpx.AsyncClient() as http_client:
-        headers = {"Authorization": f"Bearer {SLACK_BOT_TOKEN}"}
-        await http_client.post(
-            "https://slack.com/api/views.open",
-            headers=headers,
-            json={"trigger_id": trigger_id, "view": modal_view},
-        )
+    # ✅ Pass channel ID in metadata
+    modal_view = with_private_metadata(_MODEL_SELECT_VIEW_PREFIX, channel_id)
+
+    # Acknowledge the slash command without waiting on the views.open round-trip
+    spawn(app.state.http.post(
+        VIEWS_OPEN_PATH,
+        content=b'{"trigger_id":' + orjson.dumps(trigger_id) + b',"view":' + modal_view + b"}",
+    ))
 
     return PlainTextResponse("")
 
+# --- Slack Interactivity Stages ---
+# Stage 1: Push question modal
+async def select_model_stage(payload):
+    selected_model = payload["view"]["state"]["values"]["model_block"]["model_action"]["selected_option"]["value"]
+    channel_id = payload["view"]["private_metadata"]  # ✅ Retrieve channel ID
+
+    question_modal = with_private_metadata(
+        _QUESTION_VIEW_PREFIX,
+        orjson.dumps({"model": selected_model, "channel_id": channel_id}).decode(),  # ✅ Store both
+    )
+
+    return Response(
+        content=b'{"response_action":"push","view":' + question_modal + b"}",
+        media_type="application/json",
+    )
+
+# Stage 2: Handle question asynchronously
+async def submit_question_stage(payload):
+    meta = orjson.loads(payload["view"]["private_metadata"])  # ✅ Parse both
+    model = meta["model"]
+    channel_id = meta["channel_id"]  # ✅ Extract channel ID
+    question = payload["view"]["state"]["values"]["question_block"]["question_action"]["value"]
+    user_id = payload["user"]["id"]
+
+    spawn(run_bounded(process_question_async(model, question, user_id, channel_id)))  # ✅ Pass channel_id
+
+    return Response(content=orjson.dumps({"response_action": "clear"}), media_type="application/json")
+
+INTERACTION_HANDLERS = {
+    "select_model": select_model_stage,
+    "submit_question": submit_question_stage,
+}
+
 # --- Slack Interactivity Handler ---
 @app.post("/slack-interact")
 async def handle_interaction(request: Request):
+    timestamp, slack_signature = precheck_timestamp(request)
     body = await request.body()
-    verify_slack_signature(request, body)
-
-    payload = json.loads((await request.form()).get("payload"))
-    callback_id = payload["view"]["callback_id"]
-
-    # Stage 1: Push question modal
-    if callback_id == "select_model":
-        selected_model = payload["view"]["state"]["values"]["model_block"]["model_action"]["selected_option"]["value"]
-        channel_id = payload["view"]["private_metadata"]  # ✅ Retrieve channel ID
-
-        question_modal = {
-            "type": "modal",
-            "callback_id": "submit_question",
-            "private_metadata": json.dumps({"model": selected_model, "channel_id": channel_id}),  # ✅ Store both
-            "title": {"type": "plain_text", "text": "Ask a Question"},
-            "submit": {"type": "plain_text", "text": "Submit"},
-            "blocks": [
-                {
-                    "type": "input",
-                    "block_id": "question_block",
-                    "element": {
-                        "type": "plain_text_input",
-                        "action_id": "question_action",
-                        "multiline": True,
-                    },
-                    "label": {"type": "plain_text", "text": "Your question"},
-                }
-            ],
-        }
-
-        return JSONResponse({
-            "response_action": "push",
-            "view": question_modal
-        })
+    verify_body_signature(body, timestamp, slack_signature)
+    if is_replay(slack_signature):
+        return PlainTextResponse("")
 
-    # Stage 2: Handle question asynchronously
-    elif callback_id == "submit_question":
-        meta = json.loads(payload["view"]["private_metadata"])  # ✅ Parse both
-        model = meta["model"]
-        channel_id = meta["channel_id"]  # ✅ Extract channel ID
-        question = payload["view"]["state"]["values"]["question_block"]["question_action"]["value"]
-        user_id = payload["user"]["id"]
-
-        asyncio.create_task(process_question_async(model, question, user_id, channel_id))  # ✅ Pass channel_id
+    form_data = parse_slack_form(body, max_fields=4)
+    try:
+        payload = orjson.loads(form_data["payload"])
+    except (KeyError, orjson.JSONDecodeError):
+        raise HTTPException(status_code=400, detail="Malformed Slack payload.")
+    callback_id = payload.get("view", {}).get("callback_id")
 
-        return JSONResponse({"response_action": "clear"})
+    handler = INTERACTION_HANDLERS.get(callback_id)
+    if handler is None:
+        return PlainTextResponse("")
+    return await handler(payload)
 
-    return PlainTextResponse("")
+# --- Slack message posting ---
+async def post_message(channel, text):
+    await app.state.http.post(
+        POST_MESSAGE_PATH,
+        content=orjson.dumps({"channel": channel, "text": text}),
+    )
 
 # --- Background processing of the question ---
 async def process_question_async(model, question, user_id, channel_id):
     try:
-        completion = client.chat.completions.create(
+        completion = await client.chat.completions.create(
             model=model,
             messages=[{"role": "user", "content": question}],
             temperature=1,
@@ -152,30 +362,30 @@ async def process_question_async(model, question, user_id, channel_id):
             stop=None
         )
 
-        response_text = ""
-        for chunk in completion:
-            response_text += chunk.choices[0].delta.content or ""
+        parts = []
+        async for chunk in completion:
+            parts.append(chunk.choices[0].delta.content or "")
 
-        response_text = response_text.strip()
+        response_text = "".join(parts).strip()
 
         # ✅ Post publicly to channel instead of ephemeral
-        async with httpx.AsyncClient() as http_client:
-            await http_client.post(
-                "https://slack.com/api/chat.postMessage",
-                headers={"Authorization": f"Bearer {SLACK_BOT_TOKEN}"},
-                json={
-                    "channel": channel_id,
-                    "text": f"<@{user_id}> asked:\n>{question}\n\n*Answer:*\n{response_text}"
-                },
-            )
+        await post_message(channel_id, f"<@{user_id}> asked:\n>{question}\n\n*Answer:*\n{response_text}")
 
     except Exception as e:
-        async with httpx.AsyncClient() as http_client:
-            await http_client.post(
-                "https://slack.com/api/chat.postMessage",
-                headers={"Authorization": f"Bearer {SLACK_BOT_TOKEN}"},
-                json={
-                    "channel": channel_id,
-                    "text": f"Error for <@{user_id}>: {str(e)}"
-                },
-            )
+        logger.exception("Failed to answer question for %s", user_id)
+        await post_message(channel_id, f"Error for <@{user_id}>: {str(e)}")
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        loop="uvloop",
+        http="httptools",
+        # Groq concurrency and replay detection are per worker; see _GROQ_SEM / _SEEN_SIGNATURES.
+        workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+        backlog=2048,
+    )